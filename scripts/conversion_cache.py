@@ -0,0 +1,195 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "the-xml-document-stack"
+
+# Re-measure the cache from disk at least this often, in seconds. Several
+# worker processes share one cache and each only sees its own additions.
+RESCAN_INTERVAL = 600
+
+# Each entry records its own size, so measuring the cache is one small read
+# per entry rather than a stat of every file
+SIZE_FILE = ".size"
+
+# Total size found by the last measurement, so new processes can start from
+# it instead of measuring the whole cache themselves
+USAGE_FILE = ".usage"
+
+# Eviction trims the cache to this fraction of its limit, so that a full
+# cache is rescanned once per batch of stores instead of on every store
+LOW_WATER = 0.9
+
+
+def link_or_copy(src: Path, dst: Path) -> None:
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    if dst.exists():
+        dst.unlink()
+    try:
+        os.link(src, dst)
+    except OSError:  # different filesystem, or links not supported
+        shutil.copy2(src, dst)
+
+
+class ConversionCache:
+    """Conversion outputs keyed by a hash of the input bytes plus the
+    converter's name, version and options.
+
+    Identical documents (The Stack is full of forks) are converted once and
+    then hardlinked into every output directory that needs them. Each entry
+    is a directory of output files; the least recently used entries are
+    evicted once the cache grows beyond `max_bytes`.
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.size = self._read_usage()
+        if self.size is None:
+            self.size = sum(size for _, size, _ in self._scan())
+        self.last_scan = time.monotonic()
+
+    @staticmethod
+    def key(content: bytes, converter: str, version: str, options: Dict) -> str:
+        digest = hashlib.sha256()
+        digest.update(json.dumps([converter, version, options], sort_keys=True).encode())
+        digest.update(b"\0")
+        digest.update(content)
+        return digest.hexdigest()
+
+    def _entry_path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / key
+
+    def lookup(self, key: str) -> Optional[Path]:
+        entry = self._entry_path(key)
+        if not entry.is_dir():
+            return None
+        try:
+            # The entry's mtime doubles as its LRU timestamp
+            os.utime(entry)
+        except FileNotFoundError:  # evicted by another process
+            return None
+        return entry
+
+    def materialize(
+        self,
+        entry: Path,
+        dest_dir: Path,
+        rename: Optional[Dict[str, str]] = None,
+        exclude: Iterable[str] = (),
+    ) -> bool:
+        """Hardlink (or copy) the files of a cache entry into dest_dir,
+        except those in `exclude`. Returns False if the entry disappeared
+        underneath us."""
+        rename = rename or {}
+        exclude = set(exclude) | {SIZE_FILE}
+        try:
+            for file_path in entry.rglob("*"):
+                if file_path.is_dir():
+                    continue
+                relative = str(file_path.relative_to(entry))
+                if relative in exclude:
+                    continue
+                link_or_copy(file_path, dest_dir / rename.get(relative, relative))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def store(self, key: str, files: Dict[str, Union[Path, bytes]]) -> None:
+        """Add the given files, keyed by their path inside the entry, to the
+        cache. A value is either a file to copy or the file's contents."""
+        entry = self._entry_path(key)
+        if entry.is_dir():
+            return
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        # Build the entry next to its final location and rename it into
+        # place, so readers never see a half-written entry
+        tmp_dir = Path(tempfile.mkdtemp(dir=entry.parent, prefix=".tmp-"))
+        size = 0
+        for relative, src in files.items():
+            # Copy rather than link: the output could be rewritten in place
+            # later and must not change the cached version
+            dst = tmp_dir / relative
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            if isinstance(src, bytes):
+                dst.write_bytes(src)
+            else:
+                shutil.copy2(src, dst)
+            size += dst.stat().st_size
+        (tmp_dir / SIZE_FILE).write_text(str(size))
+        try:
+            os.rename(tmp_dir, entry)
+        except OSError:  # another process stored the same entry first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+
+        self.size += size
+        if (
+            self.size > self.max_bytes
+            or time.monotonic() - self.last_scan > RESCAN_INTERVAL
+        ):
+            self.evict()
+
+    def _entries(self) -> Iterator[Path]:
+        for shard in self.cache_dir.iterdir():
+            if not shard.is_dir():
+                continue
+            for entry in shard.iterdir():
+                if entry.name.startswith(".tmp-"):
+                    continue
+                yield entry
+
+    @staticmethod
+    def _entry_size(entry: Path) -> int:
+        try:
+            return int((entry / SIZE_FILE).read_text())
+        except (FileNotFoundError, ValueError):
+            return sum(f.stat().st_size for f in entry.rglob("*") if f.is_file())
+
+    def _read_usage(self) -> Optional[int]:
+        # Only trust a recent measurement; stores since then are not in it
+        usage_file = self.cache_dir / USAGE_FILE
+        try:
+            if time.time() - usage_file.stat().st_mtime > RESCAN_INTERVAL:
+                return None
+            return int(usage_file.read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_usage(self) -> None:
+        tmp_file = self.cache_dir / f"{USAGE_FILE}.{os.getpid()}"
+        tmp_file.write_text(str(self.size))
+        os.replace(tmp_file, self.cache_dir / USAGE_FILE)
+
+    def _scan(self) -> List[Tuple[float, int, Path]]:
+        """Measure the cache: (mtime, size, path) of every entry."""
+        entries = []
+        for entry in self._entries():
+            try:
+                entries.append((entry.stat().st_mtime, self._entry_size(entry), entry))
+            except FileNotFoundError:  # evicted by another process
+                continue
+        self.size = sum(size for _, size, _ in entries)
+        self.last_scan = time.monotonic()
+        self._write_usage()
+        return entries
+
+    def evict(self) -> None:
+        """Re-measure the cache and, if it exceeds max_bytes, drop least
+        recently used entries down to the low-water mark."""
+        entries = self._scan()
+        if self.size <= self.max_bytes:
+            return
+        target = self.max_bytes * LOW_WATER
+        for _, size, entry in sorted(entries, key=lambda item: item[0]):
+            if self.size <= target:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            self.size -= size
+        self._write_usage()
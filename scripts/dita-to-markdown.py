@@ -1,9 +1,19 @@
 import argparse
 import multiprocessing
 import pathlib
+import shutil
 import subprocess
 import tempfile
 from lxml import etree
+from conversion_cache import DEFAULT_CACHE_DIR, ConversionCache
+
+# Bump when a change to this script changes its output, to invalidate the
+# conversion cache
+CONVERTER_VERSION = "1"
+
+# Set per worker process by init_worker
+cache = None
+dita_version = None
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Convert DITA files to Markdown')
@@ -48,6 +58,19 @@ def process_file(input_file, input_dir, output_dir):
     if outfile.exists():
         return
 
+    if cache is not None:
+        # Output file names follow the input's name, so it is part of the key
+        key = ConversionCache.key(
+            input_file.read_bytes(),
+            "dita-to-markdown",
+            CONVERTER_VERSION,
+            {"name": input_file.name, "dita": dita_version},
+        )
+        entry = cache.lookup(key)
+        if entry is not None and cache.materialize(entry, md_output_dir):
+            print(outfile, "(cached)")
+            return
+
     # Create a temporary directory
     with tempfile.TemporaryDirectory() as temp_dir_name:
         temp_dir = pathlib.Path(temp_dir_name)
@@ -59,29 +82,56 @@ def process_file(input_file, input_dir, output_dir):
         # Adjust image paths and create placeholder image files
         adjust_image_paths_and_create_placeholders(temp_file, temp_dir)
 
+        # DITA-OT writes into a private directory: md_output_dir can contain
+        # the output directories of nested inputs, which other workers may
+        # be writing to right now
+        conversion_dir = temp_dir / "output"
+        conversion_dir.mkdir()
 
         # Prepare the error output file name
-        error_file = md_output_dir / ("error_" + input_file.stem + '.error')
+        error_file = conversion_dir / ("error_" + input_file.stem + '.error')
 
         # Execute the conversion command
-        command = f"dita --input={temp_file} --format=markdown --output={md_output_dir}"
+        command = f"dita --input={temp_file} --format=markdown --output={conversion_dir}"
         result = subprocess.run(command, shell=True, stderr=subprocess.PIPE)
+        failed = result.returncode != 0
 
         # If there was an error, write the error message to the error file
         if result.returncode != 0:
             with open(error_file, 'w') as ef:
                 ef.write(result.stderr.decode())
-        outfile.write_text(input_file.read_text())
-        print(outfile)
 
-        command = f"dita --input={temp_file} --format=html5 --output={md_output_dir}"
+        command = f"dita --input={temp_file} --format=html5 --output={conversion_dir}"
         result = subprocess.run(command, shell=True, stderr=subprocess.PIPE)
+        failed = failed or result.returncode != 0
 
         # If there was an error, write the error message to the error file
         if result.returncode != 0:
             with open(error_file, 'w') as ef:
                 ef.write(result.stderr.decode())
 
+        (conversion_dir / input_file.name).write_text(input_file.read_text())
+
+        new_files = {
+            str(path.relative_to(conversion_dir)): path
+            for path in conversion_dir.rglob("*")
+            if path.is_file()
+        }
+        # Don't turn a possibly transient DITA-OT failure into a permanent
+        # cache hit
+        if cache is not None and not failed:
+            cache.store(key, new_files)
+
+        # Move the copy of the input last: its presence marks the
+        # conversion as done
+        for relative in sorted(new_files, key=lambda relative: relative == input_file.name):
+            destination = md_output_dir / relative
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            # Replace rather than write through a hardlink into the cache
+            destination.unlink(missing_ok=True)
+            shutil.move(str(new_files[relative]), str(destination))
+        print(outfile)
+
 def process_file_wrapper(args):
     try:
         process_file(*args)
@@ -93,8 +143,21 @@ def parse_arguments():
     parser.add_argument("input_dir")
     parser.add_argument("output_dir")
     parser.add_argument("--num-processes", type=int, default=8)
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR / "dita-to-markdown", help="Directory of the conversion cache")
+    parser.add_argument("--cache-max-gb", type=float, default=10, help="Evict least recently used conversions beyond this size")
+    parser.add_argument("--no-cache", action="store_true", default=False, help="Always run the conversion")
     return parser.parse_args()
 
+def get_dita_version():
+    result = subprocess.run("dita --version", shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return result.stdout.decode().strip()
+
+def init_worker(cache_dir, cache_max_bytes, version):
+    global cache, dita_version
+    if cache_dir is not None:
+        cache = ConversionCache(pathlib.Path(cache_dir), cache_max_bytes)
+    dita_version = version
+
 def main():
     args = parse_arguments()
 
@@ -106,7 +169,10 @@ def main():
     files_to_process = list(input_dir.rglob('*.dita')) + list(input_dir.rglob('*.xml'))
     arguments_to_process = [(input_file, input_dir, output_dir) for input_file in files_to_process]
 
-    with multiprocessing.Pool(args.num_processes) as p:
+    cache_dir = None if args.no_cache else args.cache_dir
+    initargs = (cache_dir, int(args.cache_max_gb * 1024 ** 3), get_dita_version())
+
+    with multiprocessing.Pool(args.num_processes, initializer=init_worker, initargs=initargs) as p:
         p.map(process_file_wrapper, arguments_to_process)
 
     print("Conversion complete.")
@@ -5,10 +5,13 @@ import warnings
 import bs4
 import json
 import argparse
-import pandas as pd
-from typing import Hashable, List
+import threading
+from typing import Dict, List, Optional
 from pathlib import Path
 import concurrent.futures
+from sampling import STRATIFY_BY, SampleSpec, Sampler, merge_samples, write_manifest
+from stack_parquet import StackDocument, iter_documents
+from write_behind import WriteBehindWriter
 
 
 def get_exclusions() -> List[str]:
@@ -45,56 +48,95 @@ def sniff_document_type(soup: bs4.BeautifulSoup):
     
 
 
+def save_bad(write, idx: int, content, metadata: str, error: Exception) -> None:
+    error_message = f"Error at index {idx} - {str(error)}"
+    print(error_message)
+    dir_path = "xml/__BAD"
+    # Save content
+    write(f"{dir_path}/content_{idx}.txt", content)
+    # Save the row data to a JSON file
+    json_file_name = f"{dir_path}/metadata_{idx}.json"
+    metadata = json.loads(metadata)
+    metadata["ERROR"] = str(error)
+    write(json_file_name, json.dumps(metadata))
+    print(f"Saved error and metadata to: {json_file_name}")
+
+
+def on_write_error(writer: WriteBehindWriter, idx: int, content: bytes, metadata: str):
+    """Error handler for a document's writes: a document whose files can't
+    be written (e.g. a path that is too long) goes to __BAD like any other
+    failure instead of failing the whole shard."""
+    # The content and metadata writes usually fail together; report once
+    once = threading.Lock()
+
+    def handle(error: Exception) -> None:
+        if once.acquire(blocking=False):
+            save_bad(writer.write_now, idx, content, metadata, error)
+
+    return handle
+
+
 def handle_content(
-    idx: Hashable, row: pd.Series, PREFIX: str, exclusions: List[str]
+    doc: StackDocument,
+    PREFIX: bytes,
+    exclusions: List[str],
+    writer: WriteBehindWriter,
+    sampler: Optional[Sampler] = None,
 ) -> None:
-    content = row["content"]
+    idx = doc.idx
+    content = doc.content
+    if sampler is not None and not sampler.prefilter(
+        doc.get("max_stars_repo_name"), doc.get("max_stars_repo_path")
+    ):
+        return
     # Check the first 500 bytes for <!DOCTYPE
-    docstart = content[:500]
+    docstart = bytes(content[:500])
     if (
-        ("<!DOCTYPE" in docstart and "OASIS" in docstart)
-        or "<TEI" in docstart
-        or "//NLM//DTD" in docstart
+        (b"<!DOCTYPE" in docstart and b"OASIS" in docstart)
+        or b"<TEI" in docstart
+        or b"//NLM//DTD" in docstart
     ):
         try:
             with warnings.catch_warnings():
                 warnings.filterwarnings("ignore", category=UserWarning, module='bs4')
             # Parse content with BeautifulSoup
-                soup = bs4.BeautifulSoup(content, "lxml")
+                soup = bs4.BeautifulSoup(bytes(content), "lxml", from_encoding="utf-8")
             family, root = sniff_document_type(soup)
             if family:
                 # Find doctype to make doctype directories
                 if root in exclusions:
                     return
 
-                path = Path(row["max_stars_repo_path"])
-                repo = row["max_stars_repo_name"]
+                path = Path(doc.get("max_stars_repo_path"))
+                repo = doc.get("max_stars_repo_name")
                 # Create directories and save the content
                 parent_dir = f"xml/{family}/{root}/{repo}/{path.parent}"
-                Path(parent_dir).mkdir(parents=True, exist_ok=True)
                 # Save content
                 xml_file_name = f"{parent_dir}/{path.name}"
-                with open(xml_file_name, "w") as file:
-                    file.write(content)
+                # Copy out of the Arrow batch: the bytes wait in the writer's
+                # queue (and the error handler) after we move on
+                data = bytes(content)
+                metadata = doc.metadata_json()
+                on_error = on_write_error(writer, idx, data, metadata)
+                if sampler is not None:
+                    record = {
+                        "idx": idx,
+                        "family": family,
+                        "root": root,
+                        "repo": repo,
+                        "path": str(path),
+                        "file": xml_file_name,
+                    }
+                    sampler.offer(writer, record, data, metadata, on_error)
+                    return
+                writer.write(xml_file_name, data, on_error)
                 # print(f"Saved content to: {xml_file_name}")
                 # Save the row data to a JSON file
                 json_file_name = f"{xml_file_name}.json"
-                row["content"] = None
-                row.to_json(json_file_name)
+                writer.write(json_file_name, metadata, on_error)
                 # print(f"Saved metadata to: {json_file_name}")
         except Exception as e:
-            error_message = f"Error at index {idx} - {str(e)}"
-            print(error_message)
-            dir_path = "xml/__BAD"
-            Path(dir_path).mkdir(parents=True, exist_ok=True)
-            # Save content
-            with open(f"{dir_path}/content_{idx}.txt", "w") as file:
-                file.write(content)
-            # Save the row data to a JSON file
-            json_file_name = f"{dir_path}/metadata_{idx}.json"
-            row["ERROR"] = e
-            row.to_json(json_file_name)
-            print(f"Saved error and metadata to: {json_file_name}")
+            save_bad(writer.write, idx, content, doc.metadata_json(), e)
 
 
 def main():
@@ -105,32 +147,78 @@ def main():
     parser.add_argument(
         "--parallel", action="store_true", default=False, help="Enable parallel processing. May be slower!"
     )
+    parser.add_argument(
+        "--sample-rate", type=float, default=None, help="Keep each document with this probability, e.g. 0.01"
+    )
+    parser.add_argument(
+        "--sample-per-stratum", type=int, default=None, help="Keep at most this many documents per stratum"
+    )
+    parser.add_argument(
+        "--stratify-by", choices=STRATIFY_BY, default=None, help="What --sample-per-stratum counts per (default: root)"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Sampling seed. The same seed gives the same sample."
+    )
+    parser.add_argument(
+        "--manifest", type=Path, default=Path("sample_manifest.jsonl"), help="Where to describe the sample"
+    )
 
     args = parser.parse_args()
+    if args.sample_rate is not None and not 0 < args.sample_rate <= 1:
+        parser.error("--sample-rate must be in (0, 1]")
+    if args.sample_per_stratum is not None and args.sample_per_stratum < 1:
+        parser.error("--sample-per-stratum must be at least 1")
+    if args.stratify_by is not None and args.sample_per_stratum is None:
+        # A rate alone is a uniform sample; don't pretend it is stratified
+        parser.error("--stratify-by only applies with --sample-per-stratum")
+    if args.sample_per_stratum is not None and args.stratify_by is None:
+        args.stratify_by = "root"
 
     exclusions = get_exclusions()
 
+    sample_spec = None
+    if args.sample_rate is not None or args.sample_per_stratum is not None:
+        sample_spec = SampleSpec(
+            args.seed,
+            args.sample_rate,
+            args.sample_per_stratum,
+            args.stratify_by,
+            str(args.manifest.with_name(args.manifest.stem + ".staging")),
+        )
+
     if  args.parallel:
-        func = partial(handle_parquet, exclusions=exclusions)
+        func = partial(handle_parquet, exclusions=exclusions, sample_spec=sample_spec)
 
         with concurrent.futures.ProcessPoolExecutor(max_workers=4) as executor:
-            tuple(executor.map(func , args.filenames))
+            results = tuple(executor.map(func , args.filenames))
         print("DONE")
     else:
-        for filename in args.filenames:
-            handle_parquet(filename, exclusions)
+        results = [
+            handle_parquet(filename, exclusions, sample_spec) for filename in args.filenames
+        ]
 
+    if sample_spec is not None:
+        sample = merge_samples(results, sample_spec)
+        write_manifest(sample, sample_spec, args.manifest, args.filenames)
 
 
-PREFIX = "<!DOCTYPE "
 
+PREFIX = b"<!DOCTYPE "
 
-def handle_parquet(filename: str, exclusions: List[str]):
-    print("Parsing", filename)
-    df = pd.read_parquet(filename)
 
-    for idx, row in df.iterrows():
-        handle_content(idx, row, PREFIX, exclusions)
+def handle_parquet(
+    filename: str, exclusions: List[str], sample_spec: Optional[SampleSpec] = None
+) -> List[Dict]:
+    """Extract one shard. Returns the manifest records of the documents
+    sampled from it, if sampling."""
+    print("Parsing", filename)
+    sampler = Sampler(sample_spec, filename) if sample_spec is not None else None
+    with WriteBehindWriter() as writer:
+        for doc in iter_documents(filename):
+            handle_content(doc, PREFIX, exclusions, writer, sampler)
+        if sampler is not None:
+            sampler.finish(writer)
+    return sampler.sampled_records() if sampler is not None else []
 
 
 if __name__ == "__main__":
@@ -5,21 +5,22 @@ import warnings
 import bs4
 import json
 import argparse
-import pandas as pd
-from typing import Hashable, List
+from typing import List
 from pathlib import Path
 import concurrent.futures
 from find_xml_in_the_stack import get_exclusions
+from stack_parquet import StackDocument, iter_documents
+from write_behind import WriteBehindWriter
 
 
 
 
 def handle_content(
-    idx: Hashable, row: pd.Series,
+    doc: StackDocument, writer: WriteBehindWriter,
 ) -> None:
-    content = row["content"]
-    path = Path(row["max_stars_repo_path"])
-    repo = row["max_stars_repo_name"]
+    content = doc.content
+    path = Path(doc.get("max_stars_repo_path"))
+    repo = doc.get("max_stars_repo_name")
     # Create directories and save the content
     if len(content)<200:
         return
@@ -28,16 +29,13 @@ def handle_content(
         return
 
     parent_dir = f"text/{repo}/{path.parent}"
-    Path(parent_dir).mkdir(parents=True, exist_ok=True)
     # Save content
     file_name = f"{parent_dir}/{path.name}"
-    with open(file_name, "w") as file:
-        file.write(content)
-        # print(f"Saved content to: {file_name}")
-        # Save the row data to a JSON file
+    writer.write(file_name, content)
+    # print(f"Saved content to: {file_name}")
+    # Save the row data to a JSON file
     json_file_name = f"{file_name}.json"
-    row["content"] = None
-    row.to_json(json_file_name)
+    writer.write(json_file_name, doc.metadata_json())
 
 
 def main():
@@ -65,10 +63,9 @@ def main():
 
 def handle_parquet(filename: str, exclusions: List[str]):
     print("Parsing", filename)
-    df = pd.read_parquet(filename)
-
-    for idx, row in df.iterrows():
-        handle_content(idx, row)
+    with WriteBehindWriter() as writer:
+        for doc in iter_documents(filename):
+            handle_content(doc, writer)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,311 @@
+import argparse
+import concurrent.futures
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from lxml import etree
+
+# Depths at or beyond the last bin are counted in the last bin
+DEPTH_BINS = 32
+
+PROFILE_SCHEMA = pa.schema(
+    [
+        ("path", pa.string()),
+        ("family", pa.string()),
+        ("root", pa.string()),
+        ("size", pa.int64()),
+        ("n_elements", pa.int32()),
+        ("max_depth", pa.int32()),
+        ("depth_hist", pa.list_(pa.int32(), DEPTH_BINS)),
+        ("text_chars", pa.int64()),
+        ("text_ratio", pa.float32()),
+        ("tags", pa.list_(pa.string())),
+        ("tag_counts", pa.list_(pa.int32())),
+        ("attrs", pa.list_(pa.string())),
+        ("attr_counts", pa.list_(pa.int32())),
+        ("error", pa.string()),
+    ]
+)
+
+
+def iter_corpus_files(corpus_dir: Path) -> Iterable[Path]:
+    for file_path in corpus_dir.rglob("*"):
+        if file_path.is_dir() or file_path.suffix == ".json":
+            continue
+        if "__BAD" in file_path.parts:
+            continue
+        yield file_path
+
+
+def profile_file(file_path: Path, corpus_dir: Path) -> Dict:
+    """Compute the structural feature vector of one document.
+
+    Documents are laid out as {family}/{root}/{repo}/... under corpus_dir
+    by extract_xml_from_the_stack.py, which is where family and root come
+    from.
+    """
+    parts = file_path.relative_to(corpus_dir).parts
+    data = file_path.read_bytes()
+    record = {
+        "path": str(file_path),
+        "family": parts[0] if len(parts) > 2 else None,
+        "root": parts[1] if len(parts) > 2 else None,
+        "size": len(data),
+        "n_elements": 0,
+        "max_depth": 0,
+        "depth_hist": [0] * DEPTH_BINS,
+        "text_chars": 0,
+        "text_ratio": 0.0,
+        "tags": [],
+        "tag_counts": [],
+        "attrs": [],
+        "attr_counts": [],
+        "error": None,
+    }
+
+    parser = etree.XMLParser(
+        recover=True, resolve_entities=False, load_dtd=False, no_network=True, huge_tree=True
+    )
+    try:
+        root = etree.fromstring(data, parser)
+    except etree.XMLSyntaxError as e:
+        record["error"] = str(e)
+        return record
+    if root is None:
+        record["error"] = "empty document"
+        return record
+
+    tag_counter = Counter()
+    attr_counter = Counter()
+    depth_hist = record["depth_hist"]
+    text_chars = 0
+    # Iterative walk: DocBook and DITA trees get deep enough to make
+    # recursion a liability
+    stack = [(root, 0)]
+    while stack:
+        element, depth = stack.pop()
+        if depth > 0 and element.tail:
+            text_chars += len(element.tail)
+        if not isinstance(element.tag, str):  # comments and PIs
+            continue
+        name = etree.QName(element).localname
+        tag_counter[name] += 1
+        depth_hist[min(depth, DEPTH_BINS - 1)] += 1
+        record["max_depth"] = max(record["max_depth"], depth)
+        for attr in element.attrib:
+            attr_counter[f"{name}.{etree.QName(attr).localname}"] += 1
+        if element.text:
+            text_chars += len(element.text)
+        stack.extend((child, depth + 1) for child in element)
+
+    record["n_elements"] = sum(tag_counter.values())
+    record["text_chars"] = text_chars
+    # Characters of text per byte of document; close enough to a true
+    # text-to-markup ratio for the mostly-ASCII markup we deal with
+    record["text_ratio"] = text_chars / len(data) if data else 0.0
+    record["tags"] = list(tag_counter.keys())
+    record["tag_counts"] = list(tag_counter.values())
+    record["attrs"] = list(attr_counter.keys())
+    record["attr_counts"] = list(attr_counter.values())
+    return record
+
+
+def profile_file_wrapper(args) -> Optional[Dict]:
+    try:
+        return profile_file(*args)
+    except Exception as e:
+        print(f"Error profiling {args[0]}: {e}")
+        return None
+
+
+def build_profile(
+    corpus_dir: Path, out_file: Path, num_processes: int = 8, batch_size: int = 10000
+) -> None:
+    """Profile every document under corpus_dir into a parquet table, one row
+    per document. Rows are flushed every `batch_size` documents."""
+    arguments = ((file_path, corpus_dir) for file_path in iter_corpus_files(corpus_dir))
+    records = []
+    count = 0
+    with pq.ParquetWriter(out_file, PROFILE_SCHEMA) as writer:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_processes) as executor:
+            for record in executor.map(profile_file_wrapper, arguments, chunksize=64):
+                if record is None:
+                    continue
+                records.append(record)
+                if len(records) >= batch_size:
+                    writer.write_table(pa.Table.from_pylist(records, schema=PROFILE_SCHEMA))
+                    count += len(records)
+                    print(f"Profiled {count} documents")
+                    records = []
+        if records:
+            writer.write_table(pa.Table.from_pylist(records, schema=PROFILE_SCHEMA))
+            count += len(records)
+    print(f"Profiled {count} documents into {out_file}")
+
+
+def load_profile(profile_file: Path) -> pa.Table:
+    return pq.read_table(profile_file, memory_map=True)
+
+
+def documents_with_tag(table: pa.Table, tag: str) -> pa.Array:
+    """Boolean mask of the documents that use `tag` at least once."""
+    tags = table["tags"].combine_chunks()
+    matches = pc.equal(pc.list_flatten(tags), tag)
+    parents = pc.filter(pc.list_parent_indices(tags), matches)
+    mask = np.zeros(table.num_rows, dtype=bool)
+    mask[parents.to_numpy()] = True
+    return pa.array(mask)
+
+
+def select_documents(
+    table: pa.Table,
+    family: Optional[str] = None,
+    root: Optional[str] = None,
+    min_text_ratio: Optional[float] = None,
+    max_depth: Optional[int] = None,
+    min_elements: Optional[int] = None,
+    require_tags: Iterable[str] = (),
+) -> pa.Table:
+    """Filter a profile table down to the documents matching every given
+    criterion. Use this to pick training documents without re-parsing."""
+    mask = pc.is_null(table["error"])
+    if family is not None:
+        mask = pc.and_(mask, pc.equal(table["family"], family))
+    if root is not None:
+        mask = pc.and_(mask, pc.equal(table["root"], root))
+    if min_text_ratio is not None:
+        mask = pc.and_(mask, pc.greater_equal(table["text_ratio"], min_text_ratio))
+    if max_depth is not None:
+        mask = pc.and_(mask, pc.less_equal(table["max_depth"], max_depth))
+    if min_elements is not None:
+        mask = pc.and_(mask, pc.greater_equal(table["n_elements"], min_elements))
+    for tag in require_tags:
+        mask = pc.and_(mask, documents_with_tag(table, tag))
+    return table.filter(mask)
+
+
+def summarize_profile(table: pa.Table, top_tags: int = 10) -> List[Dict]:
+    """Aggregate the per-document profile per (family, root)."""
+    table = table.filter(pc.is_null(table["error"]))
+    groups = table.group_by(["family", "root"]).aggregate(
+        [
+            ("path", "count"),
+            ("size", "sum"),
+            ("n_elements", "mean"),
+            ("max_depth", "mean"),
+            ("max_depth", "max"),
+            ("text_ratio", "mean"),
+        ]
+    )
+
+    # Map every document to its group so the list columns can be summed
+    # with plain NumPy
+    keys = list(zip(groups["family"].to_pylist(), groups["root"].to_pylist()))
+    group_index = {key: i for i, key in enumerate(keys)}
+    doc_groups = np.array(
+        [
+            group_index[key]
+            for key in zip(table["family"].to_pylist(), table["root"].to_pylist())
+        ],
+        dtype=np.int64,
+    )
+
+    depth_hist = (
+        pc.list_flatten(table["depth_hist"]).to_numpy().reshape(-1, DEPTH_BINS)
+    )
+    group_depth_hist = np.zeros((len(keys), DEPTH_BINS), dtype=np.int64)
+    np.add.at(group_depth_hist, doc_groups, depth_hist)
+
+    tags = table["tags"].combine_chunks()
+    tag_table = pa.table(
+        {
+            "group": doc_groups[pc.list_parent_indices(tags).to_numpy()],
+            "tag": pc.list_flatten(tags),
+            "count": pc.list_flatten(table["tag_counts"].combine_chunks()),
+        }
+    )
+    tag_totals = tag_table.group_by(["group", "tag"]).aggregate([("count", "sum")])
+    group_tags = [Counter() for _ in keys]
+    for group, tag, count in zip(
+        tag_totals["group"].to_pylist(),
+        tag_totals["tag"].to_pylist(),
+        tag_totals["count_sum"].to_pylist(),
+    ):
+        group_tags[group][tag] = count
+
+    summary = []
+    for i, (family, root) in enumerate(keys):
+        summary.append(
+            {
+                "family": family,
+                "root": root,
+                "documents": groups["path_count"][i].as_py(),
+                "size": groups["size_sum"][i].as_py(),
+                "mean_elements": groups["n_elements_mean"][i].as_py(),
+                "mean_max_depth": groups["max_depth_mean"][i].as_py(),
+                "max_depth": groups["max_depth_max"][i].as_py(),
+                "mean_text_ratio": groups["text_ratio_mean"][i].as_py(),
+                "depth_hist": np.trim_zeros(group_depth_hist[i], "b").tolist(),
+                "top_tags": group_tags[i].most_common(top_tags),
+            }
+        )
+    summary.sort(key=lambda group: -group["documents"])
+    return summary
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Profile the structure of an extracted XML corpus once, then query the profile."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Parse the corpus into a profile.")
+    build_parser.add_argument("corpus_dir", type=Path, help="Directory written by extract_xml_from_the_stack.py, e.g. xml")
+    build_parser.add_argument("-o", "--output", type=Path, default=Path("profile.parquet"), help="Profile parquet file to write.")
+    build_parser.add_argument("--num-processes", type=int, default=8)
+
+    summarize_parser = subparsers.add_parser("summarize", help="Print statistics per family/root.")
+    summarize_parser.add_argument("profile", type=Path)
+    summarize_parser.add_argument("--top-tags", type=int, default=10)
+
+    select_parser = subparsers.add_parser("select", help="Print the paths of matching documents.")
+    select_parser.add_argument("profile", type=Path)
+    select_parser.add_argument("--family")
+    select_parser.add_argument("--root")
+    select_parser.add_argument("--min-text-ratio", type=float)
+    select_parser.add_argument("--max-depth", type=int)
+    select_parser.add_argument("--min-elements", type=int)
+    select_parser.add_argument("--require-tag", action="append", default=[], help="May be repeated.")
+
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build_profile(args.corpus_dir, args.output, args.num_processes)
+    elif args.command == "summarize":
+        for group in summarize_profile(load_profile(args.profile), args.top_tags):
+            print(f"{group['family']}/{group['root']}: {group['documents']} documents, {group['size'] / (1024 * 1024):.2f} MB")
+            print(f"  elements (mean): {group['mean_elements']:.1f}")
+            print(f"  depth (mean max / max): {group['mean_max_depth']:.1f} / {group['max_depth']}")
+            print(f"  text ratio (mean): {group['mean_text_ratio']:.3f}")
+            print(f"  depth histogram: {group['depth_hist']}")
+            print(f"  top tags: {', '.join(f'{tag}: {count}' for tag, count in group['top_tags'])}")
+    elif args.command == "select":
+        selected = select_documents(
+            load_profile(args.profile),
+            family=args.family,
+            root=args.root,
+            min_text_ratio=args.min_text_ratio,
+            max_depth=args.max_depth,
+            min_elements=args.min_elements,
+            require_tags=args.require_tag,
+        )
+        for path in selected["path"].to_pylist():
+            print(path)
+
+
+if __name__ == "__main__":
+    main()
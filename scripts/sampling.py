@@ -0,0 +1,185 @@
+import hashlib
+import heapq
+import itertools
+import json
+import shutil
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Union
+
+STRATIFY_BY = ("family", "root", "repo")
+
+
+class SampleSpec(NamedTuple):
+    seed: int = 0
+    # Keep each document with this probability
+    rate: Optional[float] = None
+    # Keep at most this many documents per stratum
+    per_stratum: Optional[int] = None
+    # Only used with per_stratum; a rate alone samples uniformly
+    stratify_by: Optional[str] = None
+    # Where per-stratum candidates wait until the global cut is known, so
+    # nothing is ever deleted from the output tree
+    staging_dir: str = "sample_staging"
+
+
+def priority(seed: int, repo: str, path: str) -> float:
+    """A pseudo-random number in [0, 1) fixed by the seed and the document's
+    identity, so a sample never depends on shard order or parallelism."""
+    digest = hashlib.blake2b(f"{seed}\0{repo}\0{path}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") / 2**64
+
+
+def stratum(record: Dict, stratify_by: Optional[str]) -> str:
+    if stratify_by is None:
+        return ""
+    if stratify_by == "root":
+        # Root element names are only meaningful within a family
+        return f"{record['family']}/{record['root']}"
+    return record[stratify_by]
+
+
+class Sampler:
+    """Sampling state for one shard.
+
+    With a rate, a document is kept when its priority is below the rate;
+    that only needs the repo and path, so unsampled documents are dropped
+    before they are parsed. With a per-stratum limit, the shard keeps the k
+    lowest-priority documents of each stratum (bottom-k sampling) and
+    writes them to the staging directory once the shard is done.
+    merge_samples then takes the global bottom k from the per-shard
+    survivors, which gives the same sample as a single pass over the whole
+    corpus, and moves only those into place.
+    """
+
+    def __init__(self, spec: SampleSpec, shard: str):
+        self.spec = spec
+        self.shard = shard
+        self.heaps = defaultdict(list)
+        self.counter = itertools.count()
+        self.records: List[Dict] = []
+
+    def prefilter(self, repo: str, path: str) -> bool:
+        # Normalize the path the same way the manifest record does, so both
+        # hash the same string
+        return (
+            self.spec.rate is None
+            or priority(self.spec.seed, repo, str(Path(path))) < self.spec.rate
+        )
+
+    def offer(
+        self,
+        writer,
+        record: Dict,
+        content: Union[bytes, memoryview],
+        metadata: str,
+        on_error: Optional[Callable[[Exception], None]] = None,
+    ) -> None:
+        """Consider an accepted document. `record` describes it for the
+        manifest and names the file it is saved to; `on_error` is passed on
+        to the writer."""
+        record["shard"] = self.shard
+        record["priority"] = priority(self.spec.seed, record["repo"], record["path"])
+        if self.spec.per_stratum is None:
+            self._save(writer, record, content, metadata, on_error)
+            return
+
+        heap = self.heaps[stratum(record, self.spec.stratify_by)]
+        # Negated priorities turn heapq's min-heap into a max-heap, so the
+        # root is the document to drop when a better one comes along. The
+        # content is copied so the Arrow batch it came from can be freed.
+        item = (-record["priority"], next(self.counter), record, bytes(content), metadata, on_error)
+        if len(heap) < self.spec.per_stratum:
+            heapq.heappush(heap, item)
+        elif item[0] > heap[0][0]:
+            heapq.heapreplace(heap, item)
+
+    def finish(self, writer) -> None:
+        """Write out the documents still held back."""
+        for heap in self.heaps.values():
+            for _, _, record, content, metadata, on_error in heap:
+                record["staged"] = str(
+                    Path(self.spec.staging_dir) / Path(self.shard).stem / record["file"]
+                )
+                self._save(writer, record, content, metadata, on_error)
+        self.heaps.clear()
+
+    def sampled_records(self) -> List[Dict]:
+        """Manifest records of everything this shard kept. Call this only
+        after the writer is closed, so every failed write has marked its
+        record."""
+        return [record for record in self.records if "error" not in record]
+
+    def _save(
+        self,
+        writer,
+        record: Dict,
+        content: Union[bytes, memoryview],
+        metadata: str,
+        on_error: Optional[Callable[[Exception], None]],
+    ) -> None:
+        def failed(error: Exception) -> None:
+            # Keep documents that never made it to disk out of the manifest
+            record["error"] = str(error)
+            if on_error is None:
+                raise error
+            on_error(error)
+
+        file_name = record.get("staged", record["file"])
+        writer.write(file_name, content, failed)
+        writer.write(f"{file_name}.json", metadata, failed)
+        self.records.append(record)
+
+
+def merge_samples(shard_records: Iterable[List[Dict]], spec: SampleSpec) -> List[Dict]:
+    """Combine the per-shard samples into the final one, moving the staged
+    documents that made the global cut into the output tree."""
+    records = list(itertools.chain.from_iterable(shard_records))
+    if spec.per_stratum is not None:
+        by_stratum = defaultdict(list)
+        for record in records:
+            by_stratum[stratum(record, spec.stratify_by)].append(record)
+        records = []
+        for stratum_records in by_stratum.values():
+            stratum_records.sort(key=lambda record: record["priority"])
+            records.extend(stratum_records[: spec.per_stratum])
+
+        for record in records:
+            staged = record.pop("staged")
+            for source, destination in (
+                (staged, record["file"]),
+                (f"{staged}.json", f"{record['file']}.json"),
+            ):
+                Path(destination).parent.mkdir(parents=True, exist_ok=True)
+                shutil.move(source, destination)
+        # Everything left behind missed the cut
+        shutil.rmtree(spec.staging_dir, ignore_errors=True)
+
+    records.sort(key=lambda record: (stratum(record, spec.stratify_by), record["priority"]))
+    return records
+
+
+def write_manifest(
+    records: List[Dict], spec: SampleSpec, manifest_path: Path, shards: List[str]
+) -> None:
+    """Write one JSON line per sampled document, plus a summary of how the
+    sample was drawn next to it."""
+    with open(manifest_path, "w") as file:
+        for record in records:
+            file.write(json.dumps(record) + "\n")
+
+    summary = {
+        "seed": spec.seed,
+        "rate": spec.rate,
+        "per_stratum": spec.per_stratum,
+        "stratify_by": spec.stratify_by,
+        "shards": list(shards),
+        "documents": len(records),
+    }
+    if spec.stratify_by is not None:
+        counts = Counter(stratum(record, spec.stratify_by) for record in records)
+        summary["strata"] = dict(counts.most_common())
+    summary_path = manifest_path.with_name(manifest_path.stem + ".summary.json")
+    with open(summary_path, "w") as file:
+        json.dump(summary, file, indent=2)
+    print(f"Sampled {len(records)} documents into {manifest_path}")
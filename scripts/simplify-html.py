@@ -1,10 +1,16 @@
 import difflib
+import json
 import re
 from typing import Set
 from bs4 import BeautifulSoup
 from pathlib import Path
 import argparse
 import markdownify
+from conversion_cache import DEFAULT_CACHE_DIR, ConversionCache
+
+# Bump when a change to this script changes its output, to invalidate the
+# conversion cache
+SIMPLIFIER_VERSION = "2"
 
 # TODO: what to do about colspan, rowspan, scope: table attributes, 
 
@@ -39,21 +45,56 @@ def process_element(element, unknown_attrs, all_elements) -> None:
     if unknown_attrs is not None:
         extra_attrs = set(element.attrs.keys()) - ATTRS_TO_KEEP
         for attr in extra_attrs:
-            attr_str = f"{element.name}.{attr}"
-            if attr_str not in unknown_attrs:
-                unknown_attrs.add(attr_str)
-                print(f"Unknown attribute: {attr_str}")
+            unknown_attrs.add(f"{element.name}.{attr}")
     if all_elements is not None:
         all_elements.add(element.name)
 
 
+def merge_report(file_unknown_attrs, file_elements, unknown_attrs, all_elements) -> None:
+    # Fold one file's findings into the run's report
+    if unknown_attrs is not None:
+        for attr_str in sorted(file_unknown_attrs - unknown_attrs):
+            unknown_attrs.add(attr_str)
+            print(f"Unknown attribute: {attr_str}")
+    if all_elements is not None:
+        all_elements.update(file_elements)
+
 
 def process_file(
     file_path: Path,
     out_dir: Path = None,
     unknown_attrs: Set = None,
     all_elements: Set = None,
+    cache: ConversionCache = None,
 ) -> None:
+    if out_dir:
+        out_path = out_dir / file_path.name
+    else:
+        out_path = Path(file_path).with_suffix(".simplified.html")
+
+    if cache is not None:
+        key = ConversionCache.key(
+            Path(file_path).read_bytes(), "simplify-html", SIMPLIFIER_VERSION, simplifier_options()
+        )
+        entry = cache.lookup(key)
+        if entry is not None and cache.materialize(
+            entry,
+            out_path.parent,
+            rename={"simplified.html": out_path.name},
+            exclude=["report.json"],
+        ):
+            # The report is cached with the output so a warm run prints the
+            # same "Unknown attributes" / "Elements" summary as a cold one
+            try:
+                report = json.loads((entry / "report.json").read_text())
+            except FileNotFoundError:
+                report = None
+            if report is not None:
+                merge_report(
+                    set(report["unknown_attrs"]), set(report["elements"]), unknown_attrs, all_elements
+                )
+                return
+
     with open(file_path, "r") as file:
         soup = BeautifulSoup(file.read(), "html.parser")
 
@@ -70,14 +111,15 @@ def process_file(
         orig = markdownify.MarkdownConverter().convert_soup(soup)
 
     # Remove all class and id attributes
+    file_unknown_attrs = set()
+    file_elements = set()
     for element in soup():
-        process_element(element, unknown_attrs, all_elements)
-
-    if out_dir:
-        out_path = out_dir / file_path.name
-    else:
-        out_path = Path(file_path).with_suffix(".simplified.html")
+        process_element(element, file_unknown_attrs, file_elements)
+    merge_report(file_unknown_attrs, file_elements, unknown_attrs, all_elements)
 
+    # The old output may be hardlinked to a cache entry; replace it rather
+    # than writing through the link
+    out_path.unlink(missing_ok=True)
     with open(out_path, "w") as file:
         file.write(str(soup))
 
@@ -92,13 +134,33 @@ def process_file(
             orig == new
         ), f"File {file_path} has changed after simplification. Please check the output: {out_path} : {diff}"
 
+    if cache is not None:
+        report = {"unknown_attrs": sorted(file_unknown_attrs), "elements": sorted(file_elements)}
+        cache.store(key, {"simplified.html": out_path, "report.json": json.dumps(report).encode()})
+
+
+def simplifier_options() -> dict:
+    # Changing any of these lists changes the output
+    return {
+        "attrs_to_delete": ATTRS_TO_DELETE,
+        "attrs_to_ignore": ATTRS_TO_IGNORE,
+        "attrs_to_keep": sorted(ATTRS_TO_KEEP),
+        "elements_to_delete": ELEMENTS_TO_DELETE,
+        "elements_to_skip": ELEMENTS_TO_SKIP,
+        "elements_to_unwrap": ELEMENTS_TO_UNWRAP,
+    }
+
 
 def process_html_files(
-    directory: Path, out_dir: Path = None, unknown_attrs: Set = None, all_elements: Set = None
+    directory: Path,
+    out_dir: Path = None,
+    unknown_attrs: Set = None,
+    all_elements: Set = None,
+    cache: ConversionCache = None,
 ) -> None:
     for file_path in directory.rglob("*.html"):
         if not str(file_path).endswith(".simplified.html"):
-            process_file(file_path, out_dir, unknown_attrs, all_elements)
+            process_file(file_path, out_dir, unknown_attrs, all_elements, cache)
 
 
 def main() -> None:
@@ -113,11 +175,29 @@ def main() -> None:
         default=None,
         help="Directory to output processed files. (Optional)",
     )
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        default=DEFAULT_CACHE_DIR / "simplify-html",
+        help="Directory of the conversion cache.",
+    )
+    parser.add_argument(
+        "--cache-max-gb",
+        type=float,
+        default=10,
+        help="Evict least recently used conversions beyond this size.",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", default=False, help="Always run the conversion."
+    )
 
     args = parser.parse_args()
     unknown_attrs = set()
     all_elements = set()
-    process_html_files(args.directory, args.outdir, unknown_attrs, all_elements)
+    cache = None
+    if not args.no_cache:
+        cache = ConversionCache(args.cache_dir, int(args.cache_max_gb * 1024 ** 3))
+    process_html_files(args.directory, args.outdir, unknown_attrs, all_elements, cache)
     if unknown_attrs:
         print("Unknown attributes", unknown_attrs)
     print("Elements", sorted(all_elements))
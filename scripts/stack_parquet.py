@@ -0,0 +1,67 @@
+import json
+from typing import Any, Iterator, NamedTuple, Optional
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+class StackDocument(NamedTuple):
+    idx: int
+    # UTF-8 bytes of the document, a zero-copy view into an Arrow buffer.
+    # Holding it keeps the whole batch alive: copy it before keeping it.
+    content: memoryview
+    batch: pa.RecordBatch
+    row: int
+
+    def get(self, column: str) -> Any:
+        return self.batch.column(column)[self.row].as_py()
+
+    def metadata_json(self, **extra: Any) -> str:
+        # Same shape as the pandas row.to_json() we used to write, with the
+        # content blanked out. Skip it rather than decode it to a str first.
+        metadata = {
+            name: None if name == "content" else self.batch.column(name)[self.row].as_py()
+            for name in self.batch.schema.names
+        }
+        metadata.update(extra)
+        return json.dumps(metadata, default=str)
+
+
+def content_views(array: pa.Array) -> Iterator[Optional[memoryview]]:
+    """Yield a memoryview over each value of a string/binary array without
+    decoding or copying it. Nulls come out as None."""
+    if pa.types.is_string(array.type) or pa.types.is_binary(array.type):
+        offset_format = "i"
+    elif pa.types.is_large_string(array.type) or pa.types.is_large_binary(array.type):
+        offset_format = "q"
+    else:
+        array = array.cast(pa.large_string())
+        offset_format = "q"
+
+    _, offsets, data = array.buffers()
+    offsets = memoryview(offsets).cast(offset_format)[
+        array.offset : array.offset + len(array) + 1
+    ]
+    data = memoryview(data) if data is not None else memoryview(b"")
+    nulls = array.is_null().to_pylist() if array.null_count else None
+
+    for i in range(len(array)):
+        if nulls and nulls[i]:
+            yield None
+        else:
+            yield data[offsets[i] : offsets[i + 1]]
+
+
+def iter_documents(filename: str, batch_size: int = 1024) -> Iterator[StackDocument]:
+    """Stream the documents of a parquet shard of The Stack.
+
+    The shard is memory-mapped and read a batch at a time, so only one
+    batch of decompressed content is resident at once and none of it is
+    turned into Python strings.
+    """
+    parquet_file = pq.ParquetFile(filename, memory_map=True)
+    idx = 0
+    for batch in parquet_file.iter_batches(batch_size=batch_size):
+        for row, content in enumerate(content_views(batch.column("content"))):
+            if content is not None:
+                yield StackDocument(idx, content, batch, row)
+            idx += 1
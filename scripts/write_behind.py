@@ -0,0 +1,118 @@
+import os
+import threading
+import concurrent.futures
+from pathlib import Path
+from typing import Callable, List, Optional, Set, Union
+
+
+class WriteBehindWriter:
+    """Write files on a background thread pool so that parsing on the
+    calling thread overlaps with disk (or network storage) latency.
+
+    Use it as a context manager: leaving the block waits for every queued
+    write to land, flushes them to disk with a single sync, and raises if
+    any write failed without an `on_error` handler to take care of it.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 4,
+        max_pending: int = 256,
+        fsync: bool = False,
+        sync_on_close: bool = True,
+    ):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        # Bounds the number of queued writes so a slow disk slows down the
+        # producer instead of letting file contents pile up in memory
+        self.slots = threading.BoundedSemaphore(max_pending)
+        # fsyncing every file is slow on networked storage; by default
+        # durability is batched into one sync at close()
+        self.fsync = fsync
+        self.sync_on_close = sync_on_close
+        self.created_dirs: Set[str] = set()
+        self.dirs_lock = threading.Lock()
+        self.errors: List[str] = []
+
+    def __enter__(self) -> "WriteBehindWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        # Don't let a failed write mask the exception already in flight
+        self.close(raise_errors=exc_type is None)
+
+    def ensure_dir(self, dir_path: str) -> None:
+        # mkdir(parents=True) costs several stat calls per level; only pay it
+        # once per directory
+        with self.dirs_lock:
+            if dir_path in self.created_dirs:
+                return
+        Path(dir_path).mkdir(parents=True, exist_ok=True)
+        with self.dirs_lock:
+            self.created_dirs.add(dir_path)
+
+    def write(
+        self,
+        file_name: str,
+        data: Union[str, bytes, memoryview],
+        on_error: Optional[Callable[[Exception], None]] = None,
+    ) -> None:
+        """Queue `data` to be written to `file_name`, creating parent
+        directories as needed. Blocks while too many writes are pending.
+
+        If the write fails, `on_error` is called with the exception on a
+        writer thread; it should use write_now() rather than queueing more
+        writes.
+        """
+        if isinstance(data, memoryview):
+            # A view keeps its whole underlying buffer alive (for
+            # stack_parquet, a decompressed batch of 1024 documents); copy
+            # it so the queue pins only the bytes it will write
+            data = data.tobytes()
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(self._write, file_name, data, on_error)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(self._done)
+
+    def _write(
+        self,
+        file_name: str,
+        data: Union[str, bytes, memoryview],
+        on_error: Optional[Callable[[Exception], None]],
+    ) -> None:
+        try:
+            self.write_now(file_name, data)
+        except Exception as e:
+            if on_error is None:
+                raise
+            on_error(e)
+
+    def write_now(self, file_name: str, data: Union[str, bytes, memoryview]) -> None:
+        """Write `data` to `file_name` synchronously, on the calling thread."""
+        self.ensure_dir(os.path.dirname(file_name) or ".")
+        mode = "w" if isinstance(data, str) else "wb"
+        with open(file_name, mode) as file:
+            file.write(data)
+            if self.fsync:
+                file.flush()
+                os.fsync(file.fileno())
+
+    def _done(self, future: concurrent.futures.Future) -> None:
+        self.slots.release()
+        error = future.exception()
+        if error is not None:
+            error_message = f"Write failed - {str(error)}"
+            print(error_message)
+            self.errors.append(error_message)
+
+    def close(self, raise_errors: bool = True) -> None:
+        """Wait for all pending writes to finish and make them durable."""
+        self.executor.shutdown(wait=True)
+        if self.sync_on_close and hasattr(os, "sync"):
+            os.sync()
+        if self.errors:
+            print(f"{len(self.errors)} writes failed")
+            if raise_errors:
+                raise OSError(f"{len(self.errors)} writes failed, first: {self.errors[0]}")